@@ -0,0 +1,223 @@
+"""Run FastTelethon transfers from the command line and report their throughput.
+
+examples:
+    python cli.py download https://t.me/c/1234567890/42 --out downloads
+    python cli.py upload big.bin --connections 8 --part-size 512 --report report.json
+    python cli.py download fake-1 fake-2 --fake --fake-size 268435456 --profile cli.prof
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from telethon import TelegramClient
+from telethon.tl.types import DocumentAttributeFilename
+
+from utils.config import load_config
+from utils.FastTelethon import ParallelTransferrer, download_file, upload_file
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# https://t.me/c/<chat>/<message>, https://t.me/c/<chat>/<topic>/<message> or https://t.me/<username>/<message>
+LINK_PATTERN = re.compile(
+    r'^(?:https?://)?(?:t|telegram)\.me/(?:(c)/(\d+)|([A-Za-z0-9_]+))(?:/\d+)?/(\d+)/?$')
+
+# Telegram only accepts part sizes that evenly divide 512 KB
+PART_SIZES_KB = (4, 8, 16, 32, 64, 128, 256, 512)
+
+
+def parse_message_link(link):
+    """Return the chat and message id a message link points to."""
+    match = LINK_PATTERN.match(link)
+    if not match:
+        raise ValueError(f"not a message link: {link}")
+
+    private, chat_id, username, message_id = match.groups()
+    chat = int(f"-100{chat_id}") if private else username
+    return chat, int(message_id)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=('download', 'upload'))
+    parser.add_argument('sources', nargs='+',
+                        help='message links to download, or local files to upload')
+    parser.add_argument('--out', default='downloads',
+                        help='directory downloaded files are written to (default: %(default)s)')
+    parser.add_argument('--send-to',
+                        help='chat uploaded files are sent to, they are only uploaded otherwise')
+    parser.add_argument('--connections', type=int,
+                        help='connections per file (default: picked from the file size)')
+    parser.add_argument('--part-size', type=int, choices=PART_SIZES_KB, metavar='KB',
+                        help='part size in KB, a power of two up to 512 (default: picked from the file size)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='files transferred at once (default: %(default)s)')
+    parser.add_argument('--report', default='-',
+                        help='where the JSON report is written, - for stdout (default: %(default)s)')
+    parser.add_argument('--profile',
+                        help='write cProfile stats to this file')
+    parser.add_argument('--wait-for-profiler', type=float, default=0, metavar='SECONDS',
+                        help='print the pid and wait before transferring, to attach py-spy')
+
+    fake = parser.add_argument_group('fake backend')
+    fake.add_argument('--fake', action='store_true',
+                      help='transfer against a local fake backend instead of telegram')
+    fake.add_argument('--fake-size', type=int, default=64 * 1024 * 1024,
+                      help='size in bytes of each downloaded file (default: %(default)s)')
+    fake.add_argument('--fake-latency', type=float, default=0.0,
+                      help='seconds per request (default: %(default)s)')
+    fake.add_argument('--fake-bandwidth', type=int, default=0,
+                      help='bytes per second per connection, 0 for unlimited (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.connections is not None and args.connections < 1:
+        parser.error('--connections must be at least 1')
+    return args
+
+
+async def create_client(args):
+    """Return a started client and the transferrer class to use with it."""
+    if args.fake:
+        from utils.fake_backend import FakeClient, FakeTransferrer
+        return FakeClient(args.fake_latency, args.fake_bandwidth), FakeTransferrer
+
+    config = load_config()
+    # A separate session so the CLI can run next to the bot
+    client = TelegramClient(f"{config['session_name']}_cli", int(config['api_id']), config['api_hash'])
+    await client.start(bot_token=config['bot_token'])
+    return client, ParallelTransferrer
+
+
+async def download_one(client, transferrer_cls, args, index, source):
+    """Download the document a message link points to and return the bytes written."""
+    if args.fake:
+        document = client.make_document(source, args.fake_size)
+        name = os.path.basename(source)
+    else:
+        chat, message_id = parse_message_link(source)
+        message = await client.get_messages(chat, ids=message_id)
+        if not message or not message.document:
+            raise ValueError(f"no document in {source}")
+        document = message.document
+        name = f"{message.id}_{os.path.basename(message.file.name or str(document.id))}"
+
+    # The source's position keeps names unique when files are downloaded at once
+    path = os.path.join(args.out, f"{index}_{name}")
+    with open(path, 'wb') as file:
+        await download_file(client, document, file, part_size_kb=args.part_size,
+                            connection_count=args.connections, transferrer_cls=transferrer_cls)
+        written = file.tell()
+
+    if written != document.size:
+        logger.warning(f"{source}: wrote {written} of {document.size} bytes")
+    return written
+
+
+async def upload_one(client, transferrer_cls, args, index, source):
+    """Upload a local file, send it if asked to, and return its size."""
+    with open(source, 'rb') as file:
+        input_file = await upload_file(client, file, part_size_kb=args.part_size,
+                                       connection_count=args.connections, transferrer_cls=transferrer_cls)
+
+    if args.send_to and not args.fake:
+        await client.send_file(args.send_to, input_file, force_document=True,
+                               attributes=[DocumentAttributeFilename(os.path.basename(source))])
+    return os.path.getsize(source)
+
+
+async def run(args):
+    """Transfer every source and return the report."""
+    client, transferrer_cls = await create_client(args)
+    transfer_one = download_one if args.mode == 'download' else upload_one
+    if args.mode == 'download':
+        os.makedirs(args.out, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def timed(index, source):
+        async with semaphore:
+            item = {'source': source, 'bytes': 0, 'seconds': 0.0, 'bytes_per_second': 0.0, 'error': None}
+            start = time.perf_counter()
+            try:
+                item['bytes'] = await transfer_one(client, transferrer_cls, args, index, source)
+            except Exception as e:
+                logger.error(f"Error transferring {source}: {e}")
+                item['error'] = str(e)
+            item['seconds'] = time.perf_counter() - start
+            if item['bytes'] and item['seconds']:
+                item['bytes_per_second'] = item['bytes'] / item['seconds']
+            logger.info(f"{source}: {item['bytes']} bytes in {item['seconds']:.2f}s")
+            return item
+
+    try:
+        start = time.perf_counter()
+        items = await asyncio.gather(*[timed(index, source) for index, source in enumerate(args.sources)])
+        elapsed = time.perf_counter() - start
+    finally:
+        if not args.fake:
+            await client.disconnect()
+
+    total_bytes = sum(item['bytes'] for item in items)
+    return {
+        'mode': args.mode,
+        'backend': 'fake' if args.fake else 'telegram',
+        'settings': {
+            'connections': args.connections,
+            'part_size_kb': args.part_size,
+            'concurrency': args.concurrency
+        },
+        'files': len(items),
+        'failed': sum(1 for item in items if item['error']),
+        'total_bytes': total_bytes,
+        'seconds': elapsed,
+        'bytes_per_second': total_bytes / elapsed if elapsed else 0.0,
+        'items': items
+    }
+
+
+def write_report(report, destination):
+    text = json.dumps(report, indent=2)
+    if destination == '-':
+        print(text)
+        return
+    with open(destination, 'w') as file:
+        file.write(text + '\n')
+    logger.info(f"Report written to {destination}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.wait_for_profiler:
+        # Gives py-spy time to attach, e.g. py-spy record --pid <pid>
+        print(f"pid {os.getpid()}, starting in {args.wait_for_profiler}s", file=sys.stderr, flush=True)
+        time.sleep(args.wait_for_profiler)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info(f"Profile written to {args.profile}")
+
+    write_report(report, args.report)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
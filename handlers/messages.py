@@ -1,11 +1,8 @@
 from telethon import events
 from telethon.tl.custom import Button
 import logging
-import asyncio
 import humanize
 import telegram_file_transfer as tft
-from telethon.tl.types import InputFileLocation
-from telethon.tl.functions.upload import GetFileRequest
 
 logger = logging.getLogger(__name__)
 
@@ -83,21 +80,21 @@ async def handle_callback(event, client):
     user_id = event.sender_id
     callback_data = event.data
 
-    # Handle cancel button for specific operations
-    operation_id = tft.get_operation_id_from_callback(callback_data)
-    if operation_id:
-        if tft.cancel_operation(operation_id):
+    # Handle cancel button for specific operations, malformed or outdated ids cancel nothing
+    if tft.is_cancel_callback(callback_data):
+        operation_id = tft.get_operation_id_from_callback(callback_data)
+        if operation_id is not None and tft.cancel_operation(operation_id, user_id):
             await event.answer('❌ Operation cancelled.')
+        else:
+            await event.answer('nothing to cancel.')
         return
 
     # Handle simple cancel button (legacy)
     if callback_data == b'cancel':
-        # Look for any operations in the active_operations dict
-        for op_id in list(tft.active_operations.keys()):
-            if op_id.startswith(str(user_id)):
-                tft.cancel_operation(op_id)
-                await event.answer('❌ Operation cancelled.')
-                break
+        if tft.cancel_user_operations(user_id):
+            await event.answer('❌ Operation cancelled.')
+        else:
+            await event.answer('nothing to cancel.')
         return
 
     # Handle file type selection
@@ -109,24 +106,28 @@ async def handle_callback(event, client):
             logger.error(f"Error deleting file type message: {e}")
 
         as_file = callback_data == b'doc'
-        status_msg = await event.respond('starting file processing... please wait.')
+        pending = pending_renames.pop(user_id)
+
+        # While draining, hand the job over to the next process instead of starting it
+        if tft.draining:
+            status_msg = await event.respond('the bot is restarting, your file will be processed shortly.')
+        else:
+            status_msg = await event.respond('starting file processing... please wait.')
+
+        job = tft.build_job(
+            user_id,
+            event.chat_id,
+            pending['message_id'],
+            pending['file_info']['size'],
+            pending['new_name'],
+            as_file,
+            status_msg.id
+        )
 
-        try:
-            # Get the original file message
-            file_message = await event.client.get_messages(event.chat_id, ids=pending_renames[user_id]['message_id'])
-
-            # Use the centralized download_and_rename function
-            await tft.download_and_rename(
-                client,
-                file_message,
-                pending_renames[user_id]['new_name'],
-                status_msg,
-                as_file
-            )
-
-            # Clear the pending rename after successful processing
-            del pending_renames[user_id]
-        except Exception as e:
-            logger.error(f"Error renaming file: {e}")
-            await status_msg.edit(
-                f"sorry, an error occurred while renaming your file: {str(e)}")
+        if tft.draining:
+            tft.deferred_jobs.append(job)
+            return
+
+        # The scheduler starts the job once the user's quotas allow it
+        if not tft.submit_job(client, job):
+            await status_msg.edit('⏳ your file is queued and will start as soon as a slot frees up.')
@@ -1,16 +1,21 @@
-from telethon import TelegramClient, events, types
-from telethon.tl.types import KeyboardButton, KeyboardButtonRow
+import time
+
+# Record process start before the heavy telethon imports so the reported
+# cold start covers everything up to run_until_disconnected
+_process_start = time.perf_counter()
+
 import os
+import sys
+import signal
 import logging
 import asyncio
-from configparser import ConfigParser
-import humanize
-import re
+from telethon import TelegramClient, events
 from utils.config import load_config
 from handlers.commands import start_command, help_command
-from handlers.messages import handle_messages, handle_callback
-import aiohttp
-# Import from our centralized module instead
+from handlers.messages import handle_messages, handle_callback, pending_renames
+from utils.state import save_state, load_state
+from utils.quota import FairScheduler
+from utils.cache import FileCache
 import telegram_file_transfer as tft
 
 # Configure logging
@@ -21,6 +26,39 @@ logger = logging.getLogger(__name__)
 # Load configuration
 config = load_config()
 
+# Jobs and pending renames handed over between processes on restart
+STATE_FILE = os.path.join('downloads', 'pending_jobs.json')
+
+# Set when a drain was requested with SIGHUP, the process re-executes itself afterwards
+restart_requested = False
+
+# How often to look for state handed over by a process that was still draining at startup
+STATE_POLL_INTERVAL = 5
+
+# The running drain, referenced so it is not garbage collected before it completes
+shutdown_task = None
+
+# Background task picking up handed over state, referenced for the same reason
+state_watch_task = None
+
+
+def install_uvloop():
+    """Install uvloop as the event loop policy if it is available."""
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("USE_UVLOOP is set but uvloop is not installed, using the default event loop")
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop event loop")
+    return True
+
+
+# The loop policy has to be in place before the client is created
+if config['use_uvloop']:
+    install_uvloop()
+
 # Initialize the client with optimized settings
 client = TelegramClient(
     config['session_name'],
@@ -30,7 +68,6 @@ client = TelegramClient(
     connection_retries=5,
     retry_delay=1,
     timeout=30,
-    # Use aiohttp for better performance
     proxy=None
 )
 
@@ -38,6 +75,18 @@ client = TelegramClient(
 client.upload_threads = 8
 client.download_threads = 8
 
+# Apply the job quotas
+tft.scheduler = FairScheduler(
+    max_concurrent=config['max_concurrent_jobs'],
+    jobs_per_user=config['jobs_per_user'],
+    jobs_per_chat=config['jobs_per_chat'],
+    user_bytes_per_hour=config['user_bytes_per_hour'],
+    chat_bytes_per_hour=config['chat_bytes_per_hour']
+)
+
+# Keep downloaded documents around for jobs on the same file
+tft.cache = FileCache(tft.CACHE_DIR, config['cache_max_bytes'])
+
 # Register command handlers
 client.add_event_handler(start_command, events.NewMessage(pattern='/start'))
 client.add_event_handler(help_command, events.NewMessage(pattern='/help'))
@@ -49,20 +98,87 @@ client.add_event_handler(lambda e: handle_callback(
     e, client), events.CallbackQuery())
 
 
+async def shutdown(restart=False):
+    """Drain active transfers and disconnect so the state can be handed over."""
+    global restart_requested
+    if tft.draining:
+        return
+
+    logger.info(f"Draining before {'restart' if restart else 'shutdown'}...")
+    restart_requested = restart
+    await tft.drain(config['drain_timeout'])
+    await client.disconnect()
+
+
+def request_shutdown(restart):
+    """Start draining in the background, called from the signal handlers."""
+    global shutdown_task
+    if shutdown_task is None:
+        shutdown_task = asyncio.create_task(shutdown(restart))
+
+
+def resume_state():
+    """Queue the jobs and restore the pending renames handed over by another process."""
+    jobs, pending = load_state(STATE_FILE)
+    for user_id, pending_rename in pending.items():
+        # A conversation started with this process wins over the handed over one
+        pending_renames.setdefault(user_id, pending_rename)
+    for job in jobs:
+        tft.submit_job(client, job)
+
+
+async def watch_state():
+    """Keep picking up handed over state.
+
+    During a rolling deploy the new process usually starts before the old one
+    has finished draining and written its state.
+    """
+    while True:
+        await asyncio.sleep(STATE_POLL_INTERVAL)
+        if tft.draining:
+            return
+        resume_state()
+
+
 async def main():
     """Start the bot."""
+    global state_watch_task
+
     # Create download directory if it doesn't exist
     os.makedirs('downloads', exist_ok=True)
 
     # Connect and start the client
     await client.start(bot_token=config['bot_token'])
 
+    # Pick up jobs handed over by the previous process, now and while it may still be draining
+    tft.prune_checkpoints()
+    resume_state()
+    state_watch_task = asyncio.create_task(watch_state())
+
+    # SIGTERM drains and exits, SIGHUP drains and restarts in a fresh process
+    loop = asyncio.get_running_loop()
+    for sig, restart in ((signal.SIGTERM, False), (signal.SIGHUP, True)):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, restart)
+        except NotImplementedError:
+            # Signal handlers are not supported on this platform
+            pass
+
     # Print bot information
     me = await client.get_me()
     print(f"Bot started as @{me.username}")
+    logger.info(f"Cold start took {time.perf_counter() - _process_start:.2f}s")
 
     # Run the client until disconnected
     await client.run_until_disconnected()
 
+    # Persist whatever the drain could not finish once no more updates arrive
+    if tft.draining:
+        save_state(STATE_FILE, tft.deferred_jobs, pending_renames)
+
 if __name__ == '__main__':
     asyncio.run(main())
+
+    if restart_requested:
+        logger.info("Restarting...")
+        os.execv(sys.executable, [sys.executable] + sys.argv)
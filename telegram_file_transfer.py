@@ -1,17 +1,82 @@
-from telethon import TelegramClient
 from telethon.tl.types import DocumentAttributeFilename
 from datetime import datetime, timedelta
 import humanize
 import os
 import logging
 import asyncio
-from utils.FastTelethon import download_file, upload_file
+import itertools
+import time
+import uuid
+from collections import Counter
 from telethon.tl.custom import Button
+from utils.FastTelethon import download_file, upload_file
+from utils.quota import FairScheduler
+from utils.cache import FileCache
 
 logger = logging.getLogger(__name__)
 
-# Dictionary to store active operations
-active_operations = {}
+
+class OperationRegistry:
+    """Active transfers indexed by operation id and user."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._operations = {}
+        self._by_user = {}
+
+    def add(self, operation):
+        """Register an operation and return its new id."""
+        operation_id = next(self._ids)
+        self._operations[operation_id] = operation
+        self._by_user.setdefault(operation.user_id, {})[operation_id] = operation
+        return operation_id
+
+    def remove(self, operation_id):
+        operation = self._operations.pop(operation_id, None)
+        if operation is None:
+            return
+        operations = self._by_user[operation.user_id]
+        del operations[operation_id]
+        if not operations:
+            del self._by_user[operation.user_id]
+
+    def get(self, operation_id):
+        return self._operations.get(operation_id)
+
+    def for_user(self, user_id):
+        return list(self._by_user.get(user_id, {}).values())
+
+    def values(self):
+        return self._operations.values()
+
+
+# Registry of active operations
+active_operations = OperationRegistry()
+
+# Ways a job can be served, from cheapest to most expensive
+PATH_RESEND = 'resend'
+PATH_CACHE = 'cache'
+PATH_FULL = 'full'
+
+# Number of jobs served by each path
+transfer_paths = Counter()
+
+# Downloaded documents reused across jobs, configured in main.py
+CACHE_DIR = os.path.join('downloads', 'cache')
+cache = FileCache(CACHE_DIR)
+
+# Downloads of interrupted jobs, complete or partial, kept for the next process
+CHECKPOINT_DIR = os.path.join('downloads', 'checkpoints')
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
+
+# Runs rename jobs within the per-user and per-chat quotas, configured in main.py
+scheduler = FairScheduler()
+
+# Set once the bot starts draining; no new transfers are started after that
+draining = False
+
+# Jobs that were refused or interrupted while draining, handed to the next process
+deferred_jobs = []
 
 
 def get_file_info(message):
@@ -50,20 +115,40 @@ def ensure_extension(new_name, original_path):
     return new_name
 
 
+def build_job(user_id, chat_id, message_id, size, new_name, as_file, status_msg_id):
+    """Build a serializable description of a rename job."""
+    return {
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'size': size,
+        'new_name': new_name,
+        'as_file': as_file,
+        'status_msg_id': status_msg_id
+    }
+
+
 class FileTransfer:
     """Class to handle file transfers with progress tracking."""
 
-    def __init__(self, status_msg, total_size):
+    # Tens of thousands of these can be alive at once
+    __slots__ = ('status_msg', 'total_size', 'user_id', 'chat_id', 'task', 'start_time',
+                 'last_update', 'cancelled', 'operation_id', 'keyboard', 'path', 'checkpoint')
+
+    def __init__(self, status_msg, total_size, user_id=None):
         self.status_msg = status_msg
         self.total_size = total_size
+        self.chat_id = status_msg.chat_id
+        self.user_id = user_id if user_id is not None else self.chat_id
+        self.task = asyncio.current_task()
         self.start_time = datetime.now()
         self.last_update = self.start_time
         self.cancelled = False
-        self.operation_id = None
+        self.path = None
+        self.checkpoint = None
 
         # Register in active operations
-        self.operation_id = f"{status_msg.chat_id}_{datetime.now().timestamp()}"
-        active_operations[self.operation_id] = self
+        self.operation_id = active_operations.add(self)
 
         # Create cancel button
         self.keyboard = [
@@ -100,111 +185,358 @@ class FileTransfer:
 
     def cleanup(self):
         """Clean up operation state."""
-        if self.operation_id in active_operations:
-            del active_operations[self.operation_id]
+        active_operations.remove(self.operation_id)
 
 
-async def download_and_rename(client, file_message, new_name, status_msg, as_file=False):
-    """Download, rename, and send back the file with optimized performance."""
-    # Create file transfer handler
-    transfer = FileTransfer(status_msg, file_message.media.document.size)
+def transfer_cost(path, size):
+    """Bytes a job moves over the network, as charged against the byte quotas."""
+    if path == PATH_RESEND:
+        return 0
+    if path == PATH_CACHE:
+        # Only the upload
+        return size
+    # Download and upload
+    return 2 * size
 
-    # Get original file info to preserve extension
-    file_info = get_file_info(file_message)
-    original_filename = file_info.get('name', 'Unknown')
 
-    # Initialize status message
-    await status_msg.edit("📥 starting download...", buttons=transfer.keyboard)
+def is_plain_document(document):
+    """Whether the document is already sent as a plain file, not as a video, audio, sticker..."""
+    return all(isinstance(attr, DocumentAttributeFilename) for attr in document.attributes)
+
+
+def plan_transfer(document, original_name, new_name, as_file):
+    """Pick the cheapest way to send `document` back as `new_name`.
+
+    A document that keeps its name and format is resent by reference. Otherwise
+    it has to be uploaded again, from the cache when it is there or being
+    downloaded by another job.
+    """
+    if new_name == original_name and (not as_file or is_plain_document(document)):
+        return PATH_RESEND
+    if cache.has(document.id):
+        return PATH_CACHE
+    return PATH_FULL
 
-    # Create temporary file paths
-    download_path = os.path.join('downloads', f'temp_{transfer.operation_id}')
-    new_path = None
+
+def save_checkpoint(download_path):
+    """Move what was downloaded so far to a checkpoint and return its path."""
+    if not os.path.exists(download_path) or not os.path.getsize(download_path):
+        return None
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    checkpoint = os.path.join(CHECKPOINT_DIR, uuid.uuid4().hex)
+    os.replace(download_path, checkpoint)
+    return checkpoint
+
+
+def prune_checkpoints(max_age=CHECKPOINT_MAX_AGE):
+    """Remove checkpoints old enough that no job will pick them up anymore.
+
+    Age is used instead of the saved jobs because a process that is still
+    draining may have written checkpoints it has not handed over yet.
+    """
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(CHECKPOINT_DIR):
+        if entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                logger.error(f"Error removing stale checkpoint {entry.path}: {e}")
+
+
+async def fetch_document(client, document, transfer, download_path, checkpoint=None):
+    """Get a local copy of `document` and return its path and whether it came from the cache.
+
+    A `checkpoint` left by an interrupted job is continued instead of starting over.
+    """
+    cached_path = cache.get(document.id)
+    if cached_path:
+        return cached_path, True
+
+    # Another job is downloading the same document, share its download
+    inflight = cache.inflight.get(document.id)
+    if inflight is not None:
+        await transfer.status_msg.edit("📥 waiting for the same file to finish downloading...", buttons=transfer.keyboard)
+        try:
+            return await asyncio.shield(inflight), True
+        except Exception as e:
+            logger.warning(f"Shared download of document {document.id} failed, downloading it again: {e}")
+
+    offset = 0
+    if checkpoint and os.path.exists(checkpoint):
+        os.replace(checkpoint, download_path)
+        offset = os.path.getsize(download_path)
+        logger.info(f"Resuming download of document {document.id} from {offset} bytes")
+    else:
+        # Create the file the download is written to
+        open(download_path, 'wb').close()
+
+    await transfer.status_msg.edit("📥 starting download...", buttons=transfer.keyboard)
+    if cache.enabled:
+        cache.begin_download(document.id)
 
     try:
-        # Download file using FastTelethon
-        with open(download_path, 'wb') as file:
-            await download_file(
-                client,
-                file_message.media.document,
-                file,
-                lambda current, total: transfer.update_progress(
-                    current, total, "📥")
-            )
+        # Download file using FastTelethon, a complete checkpoint needs no download
+        if offset < document.size:
+            with open(download_path, 'r+b') as file:
+                await download_file(
+                    client,
+                    document,
+                    file,
+                    lambda current, total: transfer.update_progress(
+                        current, total, "📥"),
+                    offset=offset
+                )
+
+        if not cache.enabled:
+            return download_path, False
+        path = cache.put(document.id, download_path)
+    except BaseException as e:
+        # Waiters must always be released, or they would wait forever
+        if cache.enabled:
+            cache.end_download(document.id, error=RuntimeError(f"download failed: {e!r}"))
+        raise
 
-        if transfer.cancelled:
-            await status_msg.edit("❌ download cancelled.")
-            return
+    cache.end_download(document.id, path)
+    return path, False
 
-        # Ensure correct extension
-        _, original_ext = os.path.splitext(original_filename)
-        if '.' not in new_name:
-            new_name += original_ext
 
-        new_path = os.path.join('downloads', new_name)
+async def download_and_rename(client, file_message, new_name, status_msg, as_file=False, user_id=None,
+                              checkpoint=None):
+    """Send back the file under its new name, taking the cheapest path available.
 
-        # Rename the file
-        os.rename(download_path, new_path)
+    Returns the path the job took, one of PATH_RESEND, PATH_CACHE or PATH_FULL.
+    When the job is cancelled by a drain, the download so far is kept in
+    `transfer.checkpoint` so the next process can continue it.
+    """
+    document = file_message.media.document
 
-        # Update status message for upload
-        await status_msg.edit(f'📤 preparing to upload "{new_name}"...', buttons=transfer.keyboard)
+    # Create file transfer handler
+    transfer = FileTransfer(status_msg, document.size, user_id)
 
-        # Upload and send the renamed file
-        with open(new_path, 'rb') as file:
-            # Upload file using FastTelethon
-            input_file = await upload_file(
-                client,
-                file,
-                lambda current, total: transfer.update_progress(
-                    current, total, "📤")
-            )
+    # Get original file info to preserve extension
+    file_info = get_file_info(file_message)
+    original_filename = file_info.get('name', 'Unknown')
+    new_name = ensure_extension(new_name, original_filename)
 
-            # Log the filename being used
-            logger.info(f"Sending file with name: {new_name}")
+    transfer.path = plan_transfer(document, original_filename, new_name, as_file)
 
-            # Create filename attribute
-            filename_attr = DocumentAttributeFilename(new_name)
+    # Temporary file path, only used when the document is not cached
+    download_path = os.path.join('downloads', f'temp_{transfer.operation_id}')
 
-            # Send the file using the InputFile returned from FastTelethon
-            await client.send_file(
-                status_msg.chat_id,
-                input_file,
-                caption=f'**{new_name}**',
-                parse_mode='md',
-                force_document=as_file,
-                attributes=[filename_attr]
-            )
+    # Keep the cached copy from being evicted by other jobs until the upload is done
+    cache.pin(document.id)
+
+    try:
+        if transfer.path == PATH_RESEND:
+            await status_msg.edit(f'📤 sending "{new_name}"...')
+            try:
+                # Send the existing document by reference, nothing is transferred
+                await client.send_file(
+                    status_msg.chat_id,
+                    document,
+                    caption=f'**{new_name}**',
+                    parse_mode='md'
+                )
+            except Exception as e:
+                logger.warning(f"Resending document {document.id} failed, transferring it instead: {e}")
+                transfer.path = PATH_FULL
+
+        if transfer.path != PATH_RESEND:
+            path, from_cache = await fetch_document(client, document, transfer, download_path, checkpoint)
+            transfer.path = PATH_CACHE if from_cache else PATH_FULL
+
+            if transfer.cancelled:
+                await status_msg.edit("❌ download cancelled.")
+                return transfer.path
+
+            # Update status message for upload
+            await status_msg.edit(f'📤 preparing to upload "{new_name}"...', buttons=transfer.keyboard)
+
+            # Upload and send the renamed file
+            with open(path, 'rb') as file:
+                # Upload file using FastTelethon
+                input_file = await upload_file(
+                    client,
+                    file,
+                    lambda current, total: transfer.update_progress(
+                        current, total, "📤")
+                )
+
+                # Log the filename being used
+                logger.info(f"Sending file with name: {new_name}")
+
+                # Create filename attribute
+                filename_attr = DocumentAttributeFilename(new_name)
+
+                # Send the file using the InputFile returned from FastTelethon
+                await client.send_file(
+                    status_msg.chat_id,
+                    input_file,
+                    caption=f'**{new_name}**',
+                    parse_mode='md',
+                    force_document=as_file,
+                    attributes=[filename_attr]
+                )
+
+        transfer_paths[transfer.path] += 1
+        logger.info(f"Operation {transfer.operation_id} for user {transfer.user_id} took the {transfer.path} path")
 
         if not transfer.cancelled:
             await status_msg.edit('done. :)', buttons=None)
+        return transfer.path
+    except asyncio.CancelledError:
+        # Interrupted by a drain, keep the download for the next process
+        try:
+            transfer.checkpoint = save_checkpoint(download_path)
+        except OSError as e:
+            logger.error(f"Error saving checkpoint: {e}")
+        raise
     except Exception as e:
         logger.error(f"Error in download_and_rename: {e}")
         if not transfer.cancelled:
             await status_msg.edit(f"❌ error: {str(e)}")
         raise
     finally:
-        # Clean up files
+        # Clean up the temporary file and an unused checkpoint, cached files are kept
         try:
-            if new_path and os.path.exists(new_path):
-                os.remove(new_path)
-            if os.path.exists(download_path) and (not new_path or download_path != new_path):
-                os.remove(download_path)
+            for leftover in (download_path, checkpoint):
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
         except Exception as e:
             logger.error(f"Error cleaning up files: {e}")
 
+        cache.unpin(document.id)
+
         # Clean up operation state
         transfer.cleanup()
 
 
-def cancel_operation(operation_id):
-    """Cancel an ongoing operation by its ID."""
-    if operation_id in active_operations:
-        active_operations[operation_id].cancel()
-        return True
-    return False
+def cancel_operation(operation_id, user_id):
+    """Cancel an ongoing operation by its ID if it belongs to the user."""
+    # Callback data comes from the client and ids are sequential, so they are not a secret
+    operation = active_operations.get(operation_id)
+    if operation is None or operation.user_id != user_id:
+        return False
+    operation.cancel()
+    return True
+
+
+def cancel_user_operations(user_id):
+    """Cancel all ongoing operations of a user and return how many were cancelled."""
+    operations = active_operations.for_user(user_id)
+    for operation in operations:
+        operation.cancel()
+    return len(operations)
+
+
+def submit_job(client, job):
+    """Queue a rename job on the scheduler and return whether it started right away.
+
+    The job is charged as a full transfer, run_job refunds the difference once
+    it knows which path the job took.
+    """
+    return scheduler.submit(
+        job.get('user_id', job['chat_id']),
+        job['chat_id'],
+        transfer_cost(PATH_FULL, job.get('size', 0)),
+        job,
+        lambda: run_job(client, job)
+    )
+
+
+async def run_job(client, job):
+    """Fetch the messages of a job and run it."""
+    user_id = job.get('user_id', job['chat_id'])
+    size = job.get('size', 0)
+    charged = transfer_cost(PATH_FULL, size)
+
+    file_message, status_msg = await client.get_messages(
+        job['chat_id'], ids=[job['message_id'], job['status_msg_id']])
+    if not status_msg:
+        status_msg = await client.send_message(job['chat_id'], 'starting file processing... please wait.')
+    if not file_message or not file_message.media:
+        scheduler.refund(user_id, job['chat_id'], charged)
+        if job.get('checkpoint') and os.path.exists(job['checkpoint']):
+            os.remove(job['checkpoint'])
+        await status_msg.edit('sorry, i could not find the original file anymore.')
+        return
+
+    try:
+        path = await download_and_rename(
+            client,
+            file_message,
+            job['new_name'],
+            status_msg,
+            job['as_file'],
+            job.get('user_id'),
+            job.get('checkpoint')
+        )
+        scheduler.refund(user_id, job['chat_id'], charged - transfer_cost(path, size))
+    except Exception as e:
+        logger.error(f"Error renaming file: {e}")
+        await status_msg.edit(
+            f"sorry, an error occurred while renaming your file: {str(e)}")
+
+
+async def drain(timeout):
+    """Stop starting jobs and wait for the running ones to finish.
+
+    Queued jobs are moved to `deferred_jobs` right away. Jobs still running
+    after `timeout` seconds are cancelled and are added to `deferred_jobs` as
+    well, together with a checkpoint of what they had downloaded.
+    """
+    global draining
+    draining = True
+    deferred_jobs.extend(scheduler.pause())
+
+    tasks = set(scheduler.running)
+    if not tasks:
+        return
+
+    logger.info(f"Draining {len(tasks)} running job(s), waiting up to {timeout}s")
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if not pending:
+        return
+
+    # Operations leave the registry once cancelled, so look them up first
+    interrupted = {task: scheduler.running[task].payload for task in pending}
+    operations = {operation.task: operation for operation in active_operations.values()
+                  if operation.task in pending}
+
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    for task, job in interrupted.items():
+        operation = operations.get(task)
+        if operation is not None and operation.checkpoint:
+            job['checkpoint'] = operation.checkpoint
+        elif operation is not None:
+            job.pop('checkpoint', None)
+        deferred_jobs.append(job)
+
+        if operation is None:
+            continue
+        try:
+            await operation.status_msg.edit("⏸ the bot is restarting, your file will be processed again shortly.")
+        except Exception as e:
+            logger.error(f"Error updating interrupted transfer status: {e}")
+
+    logger.info(f"Interrupted {len(pending)} job(s), they will be resumed after restart")
+
+
+def is_cancel_callback(callback_data):
+    """Whether callback data comes from a cancel button, including outdated ones."""
+    return callback_data.startswith(b'cancel_')
 
 
 def get_operation_id_from_callback(callback_data):
-    """Extract operation ID from callback data."""
-    if callback_data.startswith(b'cancel_'):
-        return callback_data[7:].decode()
+    """Extract operation ID from callback data, None if it is malformed or outdated."""
+    if is_cancel_callback(callback_data):
+        try:
+            return int(callback_data[7:])
+        except ValueError:
+            return None
     return None
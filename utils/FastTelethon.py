@@ -130,7 +130,7 @@ class ParallelTransferrer:
         return math.ceil((file_size / full_size) * max_count)
 
     async def _init_download(self, connections: int, file: TypeLocation, part_count: int,
-                             part_size: int) -> None:
+                             part_size: int, offset: int = 0) -> None:
         minimum, remainder = divmod(part_count, connections)
 
         def get_part_count() -> int:
@@ -144,18 +144,18 @@ class ParallelTransferrer:
         # before creating any other senders.
         self.senders = [
             await self._create_download_sender(file, 0, part_size, connections * part_size,
-                                               get_part_count()),
+                                               get_part_count(), offset),
             *await asyncio.gather(
                 *[self._create_download_sender(file, i, part_size, connections * part_size,
-                                               get_part_count())
+                                               get_part_count(), offset)
                   for i in range(1, connections)])
         ]
 
     async def _create_download_sender(self, file: TypeLocation, index: int, part_size: int,
                                       stride: int,
-                                      part_count: int) -> DownloadSender:
-        return DownloadSender(self.client, await self._create_sender(), file, index * part_size, part_size,
-                              stride, part_count)
+                                      part_count: int, offset: int = 0) -> DownloadSender:
+        return DownloadSender(self.client, await self._create_sender(), file, offset + index * part_size,
+                              part_size, stride, part_count)
 
     async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool
                            ) -> None:
@@ -207,15 +207,19 @@ class ParallelTransferrer:
 
     async def download(self, file: TypeLocation, file_size: int,
                        part_size_kb: Optional[float] = None,
-                       connection_count: Optional[int] = None) -> AsyncGenerator[bytes, None]:
+                       connection_count: Optional[int] = None,
+                       offset: int = 0) -> AsyncGenerator[bytes, None]:
         connection_count = connection_count or self._get_connection_count(
             file_size)
         part_size = (
             part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
-        part_count = math.ceil(file_size / part_size)
+        # Offset must be a multiple of the part size
+        part_count = math.ceil((file_size - offset) / part_size)
+        if part_count <= 0:
+            return
         log.debug("Starting parallel download: "
-                  f"{connection_count} {part_size} {part_count} {file!s}")
-        await self._init_download(connection_count, file, part_count, part_size)
+                  f"{connection_count} {part_size} {part_count} {offset} {file!s}")
+        await self._init_download(connection_count, file, part_count, part_size, offset)
 
         part = 0
         while part < part_count:
@@ -248,14 +252,18 @@ def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
 
 async def _internal_transfer_to_telegram(client: TelegramClient,
                                          response: BinaryIO,
-                                         progress_callback: callable
+                                         progress_callback: callable,
+                                         part_size_kb: Optional[float] = None,
+                                         connection_count: Optional[int] = None,
+                                         transferrer_cls: type = ParallelTransferrer
                                          ) -> Tuple[TypeInputFile, int]:
     file_id = helpers.generate_random_long()
     file_size = os.path.getsize(response.name)
 
     hash_md5 = hashlib.md5()
-    uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
+    uploader = transferrer_cls(client)
+    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size, part_size_kb,
+                                                                 connection_count)
     buffer = bytearray()
     for data in stream_file(response):
         if progress_callback:
@@ -288,13 +296,22 @@ async def _internal_transfer_to_telegram(client: TelegramClient,
 async def download_file(client: TelegramClient,
                         location: TypeLocation,
                         out: BinaryIO,
-                        progress_callback: callable = None
+                        progress_callback: callable = None,
+                        part_size_kb: Optional[float] = None,
+                        connection_count: Optional[int] = None,
+                        transferrer_cls: type = ParallelTransferrer,
+                        offset: int = 0
                         ) -> BinaryIO:
     size = location.size
     dc_id, location = utils.get_input_location(location)
+    # Resume from the last whole part before `offset`, `out` already holds the bytes before it
+    part_size_kb = part_size_kb or utils.get_appropriated_part_size(size)
+    offset -= offset % int(part_size_kb * 1024)
+    out.seek(offset)
+    out.truncate()
     # We lock the transfers because telegram has connection count limits
-    downloader = ParallelTransferrer(client, dc_id)
-    downloaded = downloader.download(location, size)
+    downloader = transferrer_cls(client, dc_id)
+    downloaded = downloader.download(location, size, part_size_kb, connection_count, offset)
     async for x in downloaded:
         out.write(x)
         if progress_callback:
@@ -308,7 +325,10 @@ async def download_file(client: TelegramClient,
 async def upload_file(client: TelegramClient,
                       file: BinaryIO,
                       progress_callback: callable = None,
-
+                      part_size_kb: Optional[float] = None,
+                      connection_count: Optional[int] = None,
+                      transferrer_cls: type = ParallelTransferrer
                       ) -> TypeInputFile:
-    res = (await _internal_transfer_to_telegram(client, file, progress_callback))[0]
+    res = (await _internal_transfer_to_telegram(client, file, progress_callback, part_size_kb,
+                                                connection_count, transferrer_cls))[0]
     return res
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """Downloaded documents kept on disk by document id, evicted least recently used first.
+
+    A `max_bytes` of 0 disables the cache.
+    """
+
+    def __init__(self, directory, max_bytes=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Downloads in progress by document id, so concurrent jobs for the same
+        # document wait for one download instead of starting their own
+        self.inflight = {}
+
+        # Jobs using each document, pinned entries are never evicted
+        self._pins = Counter()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, document_id):
+        return os.path.join(self.directory, str(document_id))
+
+    def get(self, document_id):
+        """Return the cached path of a document, or None if it is not cached."""
+        if not self.enabled:
+            return None
+
+        path = self._path(document_id)
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def pin(self, document_id):
+        """Keep a document from being evicted until it is unpinned."""
+        self._pins[document_id] += 1
+
+    def unpin(self, document_id):
+        self._pins[document_id] -= 1
+        if self._pins[document_id] <= 0:
+            del self._pins[document_id]
+
+    def has(self, document_id):
+        return self.enabled and (document_id in self.inflight or os.path.exists(self._path(document_id)))
+
+    def put(self, document_id, source_path):
+        """Move a downloaded file into the cache and return its cached path."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(document_id)
+        os.replace(source_path, path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.name, entry.path))
+            total += stat.st_size
+
+        pinned = {str(document_id) for document_id in self._pins}
+        for _, size, name, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name in pinned:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError as e:
+                logger.error(f"Error evicting cached file {path}: {e}")
+
+    def begin_download(self, document_id):
+        """Register a download in progress and return the future waiters will await."""
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[document_id] = future
+        return future
+
+    def end_download(self, document_id, path=None, error=None):
+        """Resolve a download in progress with its cached path or the error that stopped it."""
+        future = self.inflight.pop(document_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+            # Waiters fall back to their own download, nobody else may retrieve it
+            future.exception()
+        else:
+            future.set_result(path)
@@ -15,7 +15,18 @@ def load_config():
         'api_id': os.getenv('API_ID'),
         'api_hash': os.getenv('API_HASH'),
         'bot_token': os.getenv('BOT_TOKEN'),
-        'session_name': os.getenv('SESSION_NAME', 'dotun_bot')
+        'session_name': os.getenv('SESSION_NAME', 'dotun_bot'),
+        # Optional runtime settings
+        'use_uvloop': os.getenv('USE_UVLOOP', '').lower() in ('1', 'true', 'yes'),
+        'drain_timeout': float(os.getenv('DRAIN_TIMEOUT', '60')),
+        # Job quotas, 0 disables a limit
+        'max_concurrent_jobs': int(os.getenv('MAX_CONCURRENT_JOBS', '4')),
+        'jobs_per_user': int(os.getenv('JOBS_PER_USER', '1')),
+        'jobs_per_chat': int(os.getenv('JOBS_PER_CHAT', '0')),
+        'user_bytes_per_hour': int(os.getenv('USER_BYTES_PER_HOUR', '0')),
+        'chat_bytes_per_hour': int(os.getenv('CHAT_BYTES_PER_HOUR', '0')),
+        # Disk space for reusing downloaded documents, 0 disables the cache
+        'cache_max_bytes': int(os.getenv('CACHE_MAX_BYTES', '0'))
     }
 
     # If any required values are missing, try to load from config file
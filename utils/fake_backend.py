@@ -0,0 +1,81 @@
+import asyncio
+import zlib
+
+from telethon.tl.functions.upload import GetFileRequest, SaveFilePartRequest, SaveBigFilePartRequest
+from telethon.tl.types import Document, DocumentAttributeFilename
+from telethon.tl.types.upload import File
+from telethon.tl.types.storage import FileUnknown
+
+from utils.FastTelethon import ParallelTransferrer
+
+
+class FakeSession:
+    dc_id = 2
+    auth_key = None
+
+
+class FakeSender:
+    """Stands in for an MTProtoSender, no connection is opened."""
+
+    async def disconnect(self):
+        pass
+
+
+class FakeClient:
+    """Serves FastTelethon requests locally with a simulated latency and bandwidth.
+
+    `latency` is in seconds per request and `bandwidth` in bytes per second per
+    connection, 0 means unlimited.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.session = FakeSession()
+        self._sizes = {}
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    def make_document(self, name, size):
+        """Create a document of `size` bytes that can be downloaded from this backend."""
+        document_id = zlib.crc32(name.encode())
+        self._sizes[document_id] = size
+        return Document(
+            id=document_id,
+            access_hash=0,
+            file_reference=b'',
+            date=None,
+            mime_type='application/octet-stream',
+            size=size,
+            dc_id=self.session.dc_id,
+            attributes=[DocumentAttributeFilename(name)]
+        )
+
+    async def _simulate(self, size):
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def _call(self, sender, request):
+        if isinstance(request, GetFileRequest):
+            size = self._sizes[request.location.id]
+            length = max(0, min(request.limit, size - request.offset))
+            await self._simulate(length)
+            return File(type=FileUnknown(), mtime=None, bytes=bytes(length))
+
+        if isinstance(request, (SaveFilePartRequest, SaveBigFilePartRequest)):
+            await self._simulate(len(request.bytes))
+            return True
+
+        raise NotImplementedError(f"The fake backend does not handle {type(request).__name__}")
+
+
+class FakeTransferrer(ParallelTransferrer):
+    """ParallelTransferrer whose connections go to a FakeClient."""
+
+    async def _create_sender(self):
+        return FakeSender()
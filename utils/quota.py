@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Byte budget that refills continuously up to its capacity."""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def ready(self):
+        """Whether a new job may start. A single job may overdraw the bucket."""
+        self._refill()
+        return self.tokens > 0
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def wait_time(self):
+        """Seconds until the bucket is ready again."""
+        self._refill()
+        if self.tokens > 0:
+            return 0
+        return (1 - self.tokens) / self.refill_per_second
+
+
+class QueuedJob:
+    """A job waiting in or running on the scheduler."""
+
+    def __init__(self, user_id, chat_id, size, payload, factory):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.size = size
+        self.payload = payload
+        self.factory = factory
+        self.started = False
+
+
+class FairScheduler:
+    """Run jobs round-robin across users, within concurrency and byte quotas.
+
+    Waiting users form a ring: a user moves to the back once served, and a user
+    that starts waiting again joins at the back. A limit of 0 disables it. Byte quotas are token buckets that hold an hour
+    worth of bytes and refill continuously.
+    """
+
+    def __init__(self, max_concurrent=4, jobs_per_user=1, jobs_per_chat=0,
+                 user_bytes_per_hour=0, chat_bytes_per_hour=0):
+        self.max_concurrent = max_concurrent
+        self.jobs_per_user = jobs_per_user
+        self.jobs_per_chat = jobs_per_chat
+        self.user_bytes_per_hour = user_bytes_per_hour
+        self.chat_bytes_per_hour = chat_bytes_per_hour
+
+        # Waiting jobs per user, in round-robin order
+        self._queues = OrderedDict()
+
+        self.running = {}
+        self._user_running = Counter()
+        self._chat_running = Counter()
+        self._user_buckets = {}
+        self._chat_buckets = {}
+
+        self._timer = None
+        self._paused = False
+
+    @staticmethod
+    def _bucket(buckets, key, bytes_per_hour):
+        if not bytes_per_hour:
+            return None
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(bytes_per_hour, bytes_per_hour / 3600)
+        return bucket
+
+    def _wait_time(self, job):
+        """Seconds until `job` may start, 0 if it may start now, None if it waits on a slot."""
+        if self.jobs_per_user and self._user_running[job.user_id] >= self.jobs_per_user:
+            return None
+        if self.jobs_per_chat and self._chat_running[job.chat_id] >= self.jobs_per_chat:
+            return None
+
+        wait = 0
+        for bucket in (self._bucket(self._user_buckets, job.user_id, self.user_bytes_per_hour),
+                       self._bucket(self._chat_buckets, job.chat_id, self.chat_bytes_per_hour)):
+            if bucket:
+                wait = max(wait, bucket.wait_time())
+        return wait
+
+    def submit(self, user_id, chat_id, size, payload, factory):
+        """Queue a job and return whether it started right away.
+
+        `factory` is called without arguments to create the job's coroutine.
+        """
+        job = QueuedJob(user_id, chat_id, size, payload, factory)
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+        self._queues[user_id].append(job)
+
+        self._dispatch()
+        return job.started
+
+    def _dispatch(self):
+        """Start as many waiting jobs as the quotas allow, one user at a time."""
+        if self._paused:
+            return
+
+        retry_in = None
+        while self._queues:
+            if self.max_concurrent and len(self.running) >= self.max_concurrent:
+                return
+
+            # Find the first user in the ring whose next job may start
+            retry_in = None
+            for user_id, queue in self._queues.items():
+                wait = self._wait_time(queue[0])
+                if wait == 0:
+                    break
+                if wait is not None:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+            else:
+                break
+
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self._start(job)
+
+        # Jobs held back only by byte quotas are retried once the buckets refill
+        if retry_in is not None:
+            loop = asyncio.get_running_loop()
+            if self._timer is not None and self._timer.when() > loop.time() + retry_in:
+                self._timer.cancel()
+                self._timer = None
+            if self._timer is None:
+                self._timer = loop.call_later(retry_in, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _start(self, job):
+        job.started = True
+        self._user_running[job.user_id] += 1
+        self._chat_running[job.chat_id] += 1
+        for bucket in (self._bucket(self._user_buckets, job.user_id, self.user_bytes_per_hour),
+                       self._bucket(self._chat_buckets, job.chat_id, self.chat_bytes_per_hour)):
+            if bucket:
+                bucket.consume(job.size)
+
+        task = asyncio.create_task(job.factory())
+        self.running[task] = job
+        task.add_done_callback(self._finish)
+
+    def _finish(self, task):
+        job = self.running.pop(task)
+        for counter, key, buckets in ((self._user_running, job.user_id, self._user_buckets),
+                                      (self._chat_running, job.chat_id, self._chat_buckets)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+                # Forget idle keys whose budget has fully recovered
+                if key in buckets and buckets[key].full():
+                    del buckets[key]
+
+        if not task.cancelled() and task.exception():
+            logger.error(f"Job for user {job.user_id} failed: {task.exception()}")
+
+        self._dispatch()
+
+    def refund(self, user_id, chat_id, amount):
+        """Give back bytes charged for a job that transferred less than its size."""
+        if amount <= 0:
+            return
+        for bucket in (self._user_buckets.get(user_id), self._chat_buckets.get(chat_id)):
+            if bucket:
+                bucket.refund(amount)
+        self._dispatch()
+
+    def pause(self):
+        """Stop starting jobs and return the payloads of the ones still queued."""
+        self._paused = True
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        payloads = [job.payload for queue in self._queues.values() for job in queue]
+        self._queues.clear()
+        return payloads
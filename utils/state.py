@@ -0,0 +1,45 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def save_state(path, jobs, pending_renames):
+    """Persist deferred jobs and pending renames for the next process."""
+    state = {
+        'jobs': jobs,
+        # JSON object keys are strings, user ids are restored in load_state
+        'pending_renames': {str(user_id): pending for user_id, pending in pending_renames.items()}
+    }
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
+
+    logger.info(f"Saved {len(jobs)} job(s) and {len(pending_renames)} pending rename(s) to {path}")
+
+
+def load_state(path):
+    """Load and consume state saved by a previous process."""
+    if not os.path.exists(path):
+        return [], {}
+
+    try:
+        with open(path) as file:
+            state = json.load(file)
+        jobs = state['jobs']
+        if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+            raise ValueError("jobs is not a list of objects")
+        pending_renames = {int(user_id): pending for user_id, pending in state['pending_renames'].items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        # Keep the unreadable file around so the jobs in it can be recovered by hand
+        logger.error(f"Error loading saved state from {path}, moving it to {path}.bad: {e}")
+        os.replace(path, f"{path}.bad")
+        return [], {}
+
+    os.remove(path)
+
+    logger.info(f"Loaded {len(jobs)} job(s) and {len(pending_renames)} pending rename(s) from {path}")
+    return jobs, pending_renames